@@ -1,11 +1,20 @@
+import Queue
 import ast
+import gzip
+import hashlib
+import importlib
 import json
 import logging
 import os
 import pickletools
 import re
+import struct
+import threading
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection
 from django.db.models import Q
 from django.utils.timezone import make_aware
 from tardis.tardis_portal.models import (
@@ -19,30 +28,81 @@ from tardis.tardis_portal.models.datafile import compute_checksums
 
 log = logging.getLogger(__name__)
 
+# take checksums of previously hashed files from the content index instead
+# of hashing them again, see lookup_content_index
+CONTENT_INDEX = getattr(settings, 'SQUASHFS_CONTENT_INDEX', True)
+CONTENT_INDEX_PREFIX = 'synch_squash_parser.content'
+CONTENT_INDEX_TIMEOUT = getattr(
+    settings, 'SQUASHFS_CONTENT_INDEX_TIMEOUT', 60 * 60 * 24 * 30)
+FINGERPRINT_SAMPLE_SIZE = 64 * 1024
+
+SQUASHFS_MAGIC = 0x73717368
+# rough parse throughput, used to estimate the cost of parsing an archive
+# from its superblock. inodes include directories and links, and compressed
+# bytes are the archive size, so the default byte rate assumes the contents
+# are about twice as large as the archive
+PARSE_SECONDS_PER_INODE = getattr(
+    settings, 'SQUASHFS_PARSE_SECONDS_PER_INODE', 0.05)
+PARSE_COMPRESSED_BYTES_PER_SECOND = getattr(
+    settings, 'SQUASHFS_PARSE_COMPRESSED_BYTES_PER_SECOND', 25 * 1024 * 1024)
+PARSE_HASH_WORKERS = getattr(settings, 'SQUASHFS_PARSE_HASH_WORKERS', 2)
+PARSE_QUEUE_SIZE = 256
+# manifest snapshots of parsed archives are kept here, None disables them
+MANIFEST_DIR = getattr(settings, 'SQUASHFS_MANIFEST_DIR', None)
+
+
+SQUASHFS_STORAGE_CLASS = \
+    'tardis.tardis_portal.storage.squashfs.SquashFSStorage'
+
+
+def find_storage_box(datafile):
+    '''
+    returns the storage box of a squashfs datafile, or None
+    '''
+    s_box_options = StorageBoxOption.objects.filter(
+        key='datafile_id', value=datafile.id,
+        storage_box__django_storage_class=SQUASHFS_STORAGE_CLASS)
+    if len(s_box_options) == 0:
+        return None
+    return s_box_options[0].storage_box
+
+
+def new_storage_box(datafile):
+    '''
+    unsaved storage box for a squashfs datafile
+    '''
+    return StorageBox(
+        django_storage_class=SQUASHFS_STORAGE_CLASS,
+        max_size=datafile.size,
+        status='empty',
+        name=datafile.filename,
+        description='SquashFS Archive in DataFile id: %d, filename: %s' %
+                    (datafile.id, datafile.filename)
+    )
+
 
 def get_or_create_storage_box(datafile):
-    key_name = 'datafile_id'
-    class_name = 'tardis.tardis_portal.storage.squashfs.SquashFSStorage'
-    try:
-        s_box = StorageBoxOption.objects.get(
-            key=key_name, value=datafile.id,
-            storage_box__django_storage_class=class_name).storage_box
-    except StorageBoxOption.DoesNotExist:
-        s_box = StorageBox(
-            django_storage_class=class_name,
-            max_size=datafile.size,
-            status='empty',
-            name=datafile.filename,
-            description='SquashFS Archive in DataFile id: %d, filename: %s' %
-                        (datafile.id, datafile.filename)
-        )
+    s_box = find_storage_box(datafile)
+    if s_box is None:
+        s_box = new_storage_box(datafile)
         s_box.save()
-        StorageBoxOption(key=key_name, value=datafile.id,
+        StorageBoxOption(key='datafile_id', value=datafile.id,
                          storage_box=s_box).save()
     return s_box
 
 
-def get_squashfs_metadata(squash_sbox):
+def get_storage_instance(s_box, datafile):
+    '''
+    storage instance of a squashfs storage box, which may be unsaved
+    '''
+    if s_box.pk is not None:
+        return s_box.get_initialised_storage_instance()
+    module_name, class_name = SQUASHFS_STORAGE_CLASS.rsplit('.', 1)
+    storage_class = getattr(importlib.import_module(module_name), class_name)
+    return storage_class(datafile_id=str(datafile.id))
+
+
+def get_squashfs_metadata(squash_sbox, inst=None):
     '''
     squash file metadata
 
@@ -75,7 +135,8 @@ def get_squashfs_metadata(squash_sbox):
 
     '''
     info_path = 'frames/.info'
-    inst = squash_sbox.get_initialised_storage_instance()
+    if inst is None:
+        inst = squash_sbox.get_initialised_storage_instance()
     info = {}
     try:
         with inst.open(info_path) as info_file:
@@ -194,9 +255,94 @@ def extract_pickled_filename(pickle_path):
 
 
 def prefix_dataset(dataset, prefix):
+    '''
+    prefix the description in memory, returns True if it changed
+    '''
     if not dataset.description.startswith(prefix):
         dataset.description = '%s %s' % (prefix, dataset.description)
-        dataset.save()
+        return True
+    return False
+
+
+def content_fingerprint(file_object, size):
+    '''
+    cheap fingerprint of a file from samples of its head, middle and tail
+
+    leaves the file positioned at the start
+    '''
+    sample = FINGERPRINT_SAMPLE_SIZE
+    fingerprint = hashlib.sha1()
+    offsets = [0]
+    if size > sample:
+        offsets += [(size - sample) // 2, size - sample]
+    for offset in offsets:
+        file_object.seek(offset)
+        fingerprint.update(file_object.read(sample))
+    file_object.seek(0)
+    return fingerprint.hexdigest()
+
+
+def content_index_key(filename, size, mtime, fingerprint):
+    key = hashlib.sha1('%s\0%s\0%s\0%s' % (
+        filename.encode('utf-8') if isinstance(filename, unicode)
+        else filename, size, mtime, fingerprint))
+    return '%s:%s' % (CONTENT_INDEX_PREFIX, key.hexdigest())
+
+
+def lookup_content_index(filename, size, mtime, fingerprint):
+    '''
+    returns checksums and origin of a previously hashed file with the same
+    name, size, mtime and fingerprint, or None
+
+    the index lives in the Django cache and is shared by all archives and
+    workers using the same cache backend
+
+    the fingerprint only samples the file, so two files that match in name,
+    size, mtime and all samples but differ elsewhere get the same checksums.
+    set SQUASHFS_CONTENT_INDEX to False to hash every file in full, e.g. for
+    archives with files that are rewritten in place with identical metadata
+    '''
+    return cache.get(content_index_key(filename, size, mtime, fingerprint))
+
+
+def add_to_content_index(filename, size, mtime, fingerprint, checksums,
+                         origin):
+    cache.add(content_index_key(filename, size, mtime, fingerprint),
+              {'md5sum': checksums['md5sum'],
+               'sha512sum': checksums['sha512sum'],
+               'origin': origin},
+              CONTENT_INDEX_TIMEOUT)
+
+
+def manifest_snapshot_path(squashfile):
+    if MANIFEST_DIR is None:
+        return None
+    return os.path.join(MANIFEST_DIR, '%d.json.gz' % squashfile.id)
+
+
+def load_manifest_snapshot(squashfile):
+    '''
+    returns the snapshot saved after the last successful parse, or None
+
+    snapshot format:
+        {'info': digest of the .info metadata,
+         'files': {uri: [size, mtime, md5sum]}}
+    '''
+    path = manifest_snapshot_path(squashfile)
+    if path is None or not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rb') as snapshot_file:
+        return json.load(snapshot_file)
+
+
+def save_manifest_snapshot(squashfile, snapshot):
+    path = manifest_snapshot_path(squashfile)
+    if path is None:
+        return
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.rename(tmp_path, path)
 
 
 def split_off_run_id(path):
@@ -210,6 +356,157 @@ def split_off_run_id(path):
         return 'n/a'
 
 
+class ParsePipeline(object):
+    '''
+    reads and writes files handed over by the tree walk in the background
+
+    walk -> hash queue -> read workers -> write queue -> one write worker
+
+    both queues are bounded, so a slow stage holds up the ones before it.
+    after the first error, an abort or a stage thread dying no more work is
+    done, and submit, drain and close return False instead of waiting for
+    stages that are gone
+    '''
+
+    poll_interval = 1
+
+    def __init__(self, read, write, hash_workers=PARSE_HASH_WORKERS,
+                 queue_size=PARSE_QUEUE_SIZE):
+        self.read = read
+        self.write = write
+        self.hash_queue = Queue.Queue(queue_size)
+        self.write_queue = Queue.Queue(queue_size)
+        self.errors = []
+        self.aborted = False
+        self.dead = False
+        self.readers = [
+            threading.Thread(target=self.run_stage, args=(self.read_stage,))
+            for i in range(max(hash_workers, 1))]
+        self.writer = threading.Thread(
+            target=self.run_stage, args=(self.write_stage,))
+        for thread in self.readers + [self.writer]:
+            thread.daemon = True
+            thread.start()
+
+    def stopped(self):
+        return self.aborted or self.dead or len(self.errors) > 0
+
+    def submit(self, top, filename, dataset):
+        if self.stopped():
+            return False
+        return self.put(self.hash_queue, (top, filename, dataset),
+                        self.readers)
+
+    def abort(self):
+        '''
+        skip everything not processed yet
+        '''
+        self.aborted = True
+
+    def drain(self):
+        '''
+        wait until everything submitted so far has been written
+        '''
+        return (self.wait(self.hash_queue) and
+                self.wait(self.write_queue) and
+                not self.stopped())
+
+    def close(self):
+        for thread in self.readers:
+            self.put(self.hash_queue, None, self.readers)
+        for thread in self.readers:
+            thread.join()
+        self.put(self.write_queue, None, [self.writer])
+        self.writer.join()
+        return not self.stopped()
+
+    def put(self, queue, item, consumers):
+        '''
+        put item on queue as long as one of its consumers is alive, no more
+        work is put once a stage died
+        '''
+        while any(thread.is_alive() for thread in consumers):
+            if item is not None and self.dead:
+                return False
+            try:
+                queue.put(item, timeout=self.poll_interval)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def wait(self, queue):
+        '''
+        Queue.join that gives up when a stage died
+        '''
+        queue.all_tasks_done.acquire()
+        try:
+            while queue.unfinished_tasks:
+                if self.dead:
+                    return False
+                queue.all_tasks_done.wait(self.poll_interval)
+        finally:
+            queue.all_tasks_done.release()
+        return True
+
+    def run_stage(self, stage):
+        finished = False
+        try:
+            finished = stage()
+        finally:
+            if not finished:
+                self.dead = True
+                log.error('parse pipeline stage died')
+
+    def record_error(self, action, item, err):
+        self.errors.append(err)
+        try:
+            log.exception('%s %s failed', action, os.path.join(*item[:2]))
+        except Exception:
+            # logging must not take the stage down with it
+            pass
+
+    def read_stage(self):
+        '''
+        returns True when stopped by close
+        '''
+        while True:
+            item = self.hash_queue.get()
+            try:
+                if item is None:
+                    return True
+                if not self.stopped():
+                    top, filename, dataset = item
+                    self.put(self.write_queue,
+                             (top, filename, dataset,
+                              self.read(top, filename)),
+                             [self.writer])
+            except Exception as err:
+                self.record_error('reading', item, err)
+            finally:
+                self.hash_queue.task_done()
+
+    def write_stage(self):
+        '''
+        returns True when stopped by close
+        '''
+        try:
+            while True:
+                item = self.write_queue.get()
+                try:
+                    if item is None:
+                        return True
+                    if not self.stopped():
+                        self.write(*item)
+                except Exception as err:
+                    self.record_error('writing', item, err)
+                finally:
+                    self.write_queue.task_done()
+        finally:
+            # the writer thread has its own database connection
+            connection.close()
+
+
 class ASSquashParser(object):
     '''
     if frames:
@@ -271,7 +568,12 @@ class ASSquashParser(object):
         '': {'description': 'other files'},
     }
 
-    def __init__(self, squashfile, ns):
+    def __init__(self, squashfile, ns, hash_workers=PARSE_HASH_WORKERS,
+                 read_only=False):
+        '''
+        read_only parsers don't create the archive's storage box if it is
+        missing, but work with an unsaved one
+        '''
         self.epn = DatafileParameterSet.objects.get(
             datafile=squashfile,
             schema__namespace=ns
@@ -285,27 +587,167 @@ class ASSquashParser(object):
             experimentparameterset__experimentparameter__name__name='EPN',
             experimentparameterset__experimentparameter__string_value=self.epn,
             experimentparameterset__experimentparameter__name__schema__namespace=exp_ns)
-        self.s_box = get_or_create_storage_box(squashfile)
-        self.metadata = get_squashfs_metadata(self.s_box)
+        self.squashfile = squashfile
+        if read_only:
+            self.s_box = find_storage_box(squashfile) or \
+                new_storage_box(squashfile)
+        else:
+            self.s_box = get_or_create_storage_box(squashfile)
+        self.sq_inst = get_storage_instance(self.s_box, squashfile)
+        self.metadata = get_squashfs_metadata(self.s_box, self.sq_inst)
 
-        self.sq_inst = self.s_box.get_initialised_storage_instance()
+        # (uri, origin) of files whose checksums came from the content index
+        self.duplicates = []
+        # datasets of existing datafiles by id, changed ones are saved by
+        # flush_datasets
+        self.datasets = {}
+        self.dirty_datasets = set()
+        self.tagged_datasets = set()
+        self.hash_workers = hash_workers
+        self.pipeline = None
+        self.existing_uris = set()
+        # md5sums by uri for the manifest snapshot
+        self.checksums = {}
+        # uris and their parent directories to parse, None parses everything
+        self.delta = None
+        self.delta_dirs = None
+        self.changed = set()
 
     def parse(self):
+        '''
+        walks the archive while files are hashed and written to the database
+        by a ParsePipeline
+
+        if a manifest snapshot of an earlier parse exists, only files added
+        or changed since are parsed
+        '''
         top = '.'
         dirnames, filenames = self.listdir('.')
         if len(dirnames) == 0 and len(filenames) == 0:
             return False
+        manifest = None
+        if MANIFEST_DIR is not None:
+            manifest = self.build_manifest()
+            snapshot = load_manifest_snapshot(self.squashfile)
+            if snapshot is not None:
+                self.start_delta(snapshot, manifest)
+        existing_dfos = DataFileObject.objects.filter(
+            storage_box=self.s_box,
+            datafile__dataset__experiments=self.experiment)
+        if self.delta is not None:
+            existing_dfos = existing_dfos.filter(uri__in=list(self.delta))
+        for uri, md5sum in existing_dfos.values_list(
+                'uri', 'datafile__md5sum'):
+            self.existing_uris.add(uri)
+            self.checksums[uri] = md5sum
+        self.pipeline = ParsePipeline(
+            self.read_file_details, self.create_dfo, self.hash_workers)
+        filenames = self.changed_entries(top, [], filenames)[1]
         result = True
-        if len(filenames) > 0:
-            def_dataset = self.get_or_create_dataset('other files')
-            result = result and self.add_files(top, filenames, def_dataset)
-        for dirname in dirnames:
-            if dirname == 'frames':
-                result = result and self.parse_frames()
-            elif dirname == 'home':
-                result = result and self.parse_home()
+        try:
+            if len(filenames) > 0:
+                def_dataset = self.get_or_create_dataset('other files')
+                result = result and self.add_files(
+                    top, filenames, def_dataset)
+            for dirname in dirnames:
+                if self.unchanged(dirname):
+                    continue
+                if dirname == 'frames':
+                    result = result and self.parse_frames()
+                elif dirname == 'home':
+                    result = result and self.parse_home()
+        except Exception:
+            self.pipeline.abort()
+            raise
+        finally:
+            result = self.pipeline.close() and result
+            # keep the dataset changes made so far when the parse is
+            # interrupted, e.g. by the time limit
+            self.flush_datasets()
+        self.report_duplicates()
+        if result and manifest is not None:
+            save_manifest_snapshot(self.squashfile, {
+                'info': self.info_digest(),
+                'files': dict(
+                    (uri, [size, mtime, self.checksums.get(uri)])
+                    for uri, (size, mtime) in manifest.items())})
         return result
 
+    def start_delta(self, snapshot, manifest):
+        '''
+        limit this parse to files added or changed since the snapshot and
+        unregister files removed since
+
+        changed files keep their datafile, which is updated in place unless
+        other storage boxes hold copies of it, see update_datafiles
+        '''
+        old_files = snapshot['files']
+        added = set(manifest.keys()) - set(old_files.keys())
+        removed = set(old_files.keys()) - set(manifest.keys())
+        changed = set(uri for uri in set(manifest.keys()) - added
+                      if list(manifest[uri]) != old_files[uri][:2])
+        self.remove_files(removed)
+        self.changed = changed
+        self.delta = added | changed
+        self.delta_dirs = set()
+        for uri in self.delta:
+            path = os.path.dirname(uri)
+            while path not in ('', '.') and path not in self.delta_dirs:
+                self.delta_dirs.add(path)
+                path = os.path.dirname(path)
+        for uri in set(manifest.keys()) - self.delta:
+            self.checksums[uri] = old_files[uri][2]
+        if snapshot.get('info') != self.info_digest():
+            self.retag_users()
+        log.info('EPN %s: %d files added, %d changed, %d removed since the '
+                 'last parse', self.epn, len(added), len(changed),
+                 len(removed))
+
+    def unchanged(self, path):
+        '''
+        True if nothing below path needs to be parsed
+        '''
+        return self.delta_dirs is not None and path not in self.delta_dirs
+
+    def unchanged_file(self, uri):
+        return self.delta is not None and uri not in self.delta
+
+    def changed_entries(self, top, dirnames, filenames):
+        '''
+        the entries of top that need parsing, all of them outside a delta
+        parse
+        '''
+        return ([dirname for dirname in dirnames
+                 if not self.unchanged(os.path.join(top, dirname))],
+                [filename for filename in filenames
+                 if not self.unchanged_file(os.path.join(top, filename))])
+
+    def remove_files(self, uris):
+        '''
+        unregister files from this archive, datafiles are deleted with their
+        last file object
+        '''
+        if len(uris) == 0:
+            return
+        dfos = DataFileObject.objects.filter(
+            storage_box=self.s_box, uri__in=list(uris))
+        df_ids = list(set(dfos.values_list('datafile_id', flat=True)))
+        dfos.delete()
+        DataFile.objects.filter(
+            id__in=df_ids, file_objects__isnull=True).delete()
+
+    def info_digest(self):
+        return hashlib.md5(json.dumps(
+            self.metadata, sort_keys=True, default=str)).hexdigest()
+
+    def retag_users(self):
+        '''
+        update the user tags of all datasets after the .info file changed
+        '''
+        for dataset in Dataset.objects.filter(
+                experiments=self.experiment, directory__isnull=False):
+            self.tag_user(dataset, dataset.directory, overwrite=True)
+
     def parse_frames(self):
         '''
         add calibration frames to calibration dataset
@@ -313,25 +755,35 @@ class ASSquashParser(object):
         '''
         top = 'frames'
         dirnames, filenames = self.listdir(top)
-        result = self.add_files(top, filenames)
-        if 'calibration' in dirnames:
-            cal_dataset = self.get_or_create_dataset(
-                '00 calibration', os.path.join(top, 'calibration'))
-            result = result and self.add_subdir(
-                os.path.join(top, 'calibration'), cal_dataset,
-                ignore=self.frames_ignore_paths)
-            dirnames.remove('calibration')
-        if len(dirnames) > 0:
-            result = result and all([
-                                        self.add_subdir(
-                                            os.path.join(top, dirname),
-                                            ignore=self.frames_ignore_paths)
-                                        for dirname in dirnames])
-        return result
+        drained = False
+        try:
+            result = self.add_files(top, filenames)
+            if 'calibration' in dirnames and \
+                    not self.unchanged(os.path.join(top, 'calibration')):
+                cal_dataset = self.get_or_create_dataset(
+                    '00 calibration', os.path.join(top, 'calibration'))
+                result = result and self.add_subdir(
+                    os.path.join(top, 'calibration'), cal_dataset,
+                    ignore=self.frames_ignore_paths)
+            if 'calibration' in dirnames:
+                dirnames.remove('calibration')
+            for dirname in dirnames:
+                result = result and self.add_subdir(
+                    os.path.join(top, dirname),
+                    ignore=self.frames_ignore_paths)
+            # auto processing links look up the frames in the database
+            drained = self.pipeline.drain()
+        finally:
+            # the writer may still change cached datasets until drained,
+            # otherwise parse flushes them once the pipeline is closed
+            if drained:
+                self.flush_datasets()
+        return drained and result
 
     def parse_home(self):
         top = 'home'
         dirnames, filenames = self.listdir(top)
+        filenames = self.changed_entries(top, [], filenames)[1]
         result = True
         if len(filenames) > 0:
             home_dataset = self.get_or_create_dataset('home folder', top)
@@ -340,6 +792,8 @@ class ASSquashParser(object):
             if self.typical_home[dirname].get('ignore', False):
                 continue
             subdir = os.path.join(top, dirname)
+            if self.unchanged(subdir):
+                continue
             subdir_dirs, subdir_files = self.listdir(subdir)
             if len(subdir_dirs) == 0 and len(subdir_files) == 0:
                 continue
@@ -347,6 +801,8 @@ class ASSquashParser(object):
                 self.typical_home[dirname]['description'], subdir)
             result = result and self.add_subdir(subdir, dataset)
         for dirname in set(dirnames) - set(self.typical_home.keys()):
+            if self.unchanged(os.path.join(top, dirname)):
+                continue
             result = result and self.parse_user_dir(dirname)
         return result
 
@@ -355,8 +811,10 @@ class ASSquashParser(object):
         dirnames, filenames = self.listdir(top)
         result = True
         if 'auto' in dirnames:
-            result = result and self.parse_auto_processing(userdir)
+            if not self.unchanged(os.path.join(top, 'auto')):
+                result = result and self.parse_auto_processing(userdir)
             dirnames.remove('auto')
+        dirnames, filenames = self.changed_entries(top, dirnames, filenames)
         if len(dirnames) == 0 and len(filenames) == 0:
             return result
         user_dataset = self.get_or_create_dataset(
@@ -379,20 +837,28 @@ class ASSquashParser(object):
         '''
         top = os.path.join('home', userdir, 'auto')
         dirnames, filenames = self.listdir(top)
-        result = True
+        # processed data can link to raw data in home folders
+        result = self.pipeline.drain()
         if 'indexing_results.txt' in filenames:
-            result = result and self.parse_indexing_results(userdir)
-            result = result and self.add_files(top, [
+            if not self.unchanged(os.path.join(top, 'index')):
+                result = result and self.parse_indexing_results(userdir)
+            summary = self.changed_entries(top, [], [
                 'indexing_results.txt',
                 'indexing_results.html'
-            ], self.get_or_create_dataset('indexing summary, user %s' %
-                                          userdir, top))
+            ])[1]
+            if len(summary) > 0:
+                result = result and self.add_files(
+                    top, summary,
+                    self.get_or_create_dataset(
+                        'indexing summary, user %s' % userdir, top))
             filenames.remove('indexing_results.txt')
             filenames.remove('indexing_results.html')
             dirnames.remove('index')
         if 'dataset' in dirnames:
-            result = result and self.parse_auto_dataset(userdir)
+            if not self.unchanged(os.path.join(top, 'dataset')):
+                result = result and self.parse_auto_dataset(userdir)
             dirnames.remove('dataset')
+        dirnames, filenames = self.changed_entries(top, dirnames, filenames)
         if len(filenames) > 0 or len(dirnames) > 0:
             other_ds = self.get_or_create_dataset(
                 'other auto-files, user %s' % userdir, top)
@@ -418,6 +884,12 @@ class ASSquashParser(object):
         other_dirs = []
         for dirname in dirnames:
             full_path = os.path.join(top, dirname)
+            marker = '%sfailed' % dirname
+            if self.unchanged(full_path) and \
+                    self.unchanged_file(os.path.join(top, marker)):
+                if marker in filenames:
+                    filenames.remove(marker)
+                continue
             try:
                 raw_image_path = extract_pickled_filename(self.sq_inst.path(
                     os.path.join(full_path, 'DISTL_pickle')))
@@ -447,6 +919,8 @@ class ASSquashParser(object):
             result = result and self.add_subdir(full_path, dataset=dataset)
             if raw_datafile is not None:
                 auto_indexing_link(raw_datafile, dataset)
+        other_dirs, filenames = self.changed_entries(
+            top, other_dirs, filenames)
         if len(other_dirs) > 0 or len(filenames) > 0:
             other_ds = self.get_or_create_dataset(
                 'other index-files for %s' % userdir, top)
@@ -470,6 +944,12 @@ class ASSquashParser(object):
             match = regex.match(dirname)
             if match:
                 ds_dir = os.path.join(top, dirname)
+                logfile = '%s.log' % dirname
+                if self.unchanged(ds_dir) and \
+                        self.unchanged_file(os.path.join(top, logfile)):
+                    if logfile in filenames:
+                        filenames.remove(logfile)
+                    continue
                 try:
                     raw_dataset_path = os.readlink(
                         self.sq_inst.path(os.path.join(ds_dir, 'img')))
@@ -498,12 +978,13 @@ class ASSquashParser(object):
                             store_auto_id(raw_dataset, match.groups()[3])
                         auto_processing_link(raw_dataset, dataset)
                 result = result and self.add_subdir(ds_dir, dataset)
-                logfile = '%s.log' % dirname
                 if logfile in filenames:
                     result = result and self.add_file(top, logfile, dataset)
                     filenames.remove(logfile)
             else:
                 other_dirs.append(dirname)
+        other_dirs, filenames = self.changed_entries(
+            top, other_dirs, filenames)
         if len(other_dirs) > 0 or len(filenames) > 0:
             other_ds = self.get_or_create_dataset(
                 'Auto processing other files, user %s' % userdir, top)
@@ -516,10 +997,16 @@ class ASSquashParser(object):
         return result
 
     def add_file(self, top, filename, dataset=None):
-        if self.find_existing_dfo(top, filename):
+        '''
+        hand the file to the pipeline unless this parser registered it before
+        or it is unchanged since the last parse
+        '''
+        uri = os.path.join(top, filename)
+        if self.delta is not None and uri not in self.delta:
             return True
-        else:
-            return self.create_dfo(top, filename, dataset)
+        if uri in self.existing_uris and uri not in self.changed:
+            return True
+        return self.pipeline.submit(top, filename, dataset)
 
     def add_files(self, top, filenames, dataset=None):
         if len(filenames) == 0:
@@ -532,6 +1019,8 @@ class ASSquashParser(object):
         add a subdirectory and all children
         ignore folders that are defined in the ignore list
         '''
+        if self.unchanged(subdir):
+            return True
         dirnames, filenames = self.listdir(subdir)
         if ignore is not None:
             for path in ignore:
@@ -545,15 +1034,21 @@ class ASSquashParser(object):
                                      for dirname in dirnames])
         return result
 
-    def create_dfo(self, top, filename, dataset=None):
+    def create_dfo(self, top, filename, dataset, df_data):
         '''
         create dfo and datafile if necessary
+
+        df_data comes from read_file_details
         '''
-        df, df_data = self.find_datafile(top, filename)
-        if df is None and df_data is None:
+        if df_data == {}:
             return True  # is a link
+        uri = os.path.join(top, filename)
+        if uri in self.changed and uri in self.existing_uris and \
+                self.update_datafiles(top, filename, df_data):
+            return True
+        df = self.find_datafile(top, filename, df_data)
         if df:
-            if dataset is not None and df.dataset.id != dataset.id:
+            if dataset is not None and df.dataset_id != dataset.id:
                 # olddataset_id = df.dataset.id
                 df.dataset = dataset
                 df.save()
@@ -562,8 +1057,9 @@ class ASSquashParser(object):
                 #     oldds.delete()
             elif dataset is None and top.startswith('frames'):
                 prefix = 'Raw data for'
-                prefix_dataset(df.dataset, prefix)
-            self.update_dataset(df.dataset, top)
+                if prefix_dataset(self.cached_dataset(df), prefix):
+                    self.dirty_datasets.add(df.dataset_id)
+            self.update_dataset(self.cached_dataset(df), top)
         else:
             if dataset is None:
                 dataset = self.get_or_create_dataset('lost and found')
@@ -579,15 +1075,56 @@ class ASSquashParser(object):
             uri=os.path.join(top, filename)
         )
         dfo.save()
+        self.checksums[dfo.uri] = df_data['md5sum']
         return True
 
-    def find_datafile(self, top, filename):
-        fullpath = os.path.join(top, filename)
-        # df_data usually is {md5, sha512, size}
-        df_data = self.get_file_details(
-            top, filename)
-        if df_data == {}:
-            return None, None
+    def update_datafiles(self, top, filename, df_data):
+        '''
+        rewrite size, checksums and times of the datafiles registered for a
+        file that changed since the last parse
+
+        datafiles that also have file objects in other storage boxes still
+        describe those copies, so only this box's file object is removed.
+        returns False if no datafile was updated and the file has to be
+        registered again
+        '''
+        uri = os.path.join(top, filename)
+        updated = False
+        for dfo in DataFileObject.objects.filter(
+                storage_box=self.s_box, uri=uri).select_related('datafile'):
+            df = dfo.datafile
+            if df.file_objects.exclude(id=dfo.id).exists():
+                dfo.delete()
+                continue
+            for key, value in df_data.items():
+                setattr(df, key, value)
+            df.save()
+            updated = True
+        if updated:
+            self.checksums[uri] = df_data['md5sum']
+        return updated
+
+    def cached_dataset(self, df):
+        '''
+        the one instance of a datafile's dataset used during this parse
+        '''
+        if df.dataset_id not in self.datasets:
+            self.datasets[df.dataset_id] = df.dataset
+        return self.datasets[df.dataset_id]
+
+    def flush_datasets(self):
+        '''
+        save changed descriptions and directories of cached datasets
+        '''
+        for ds_id in self.dirty_datasets:
+            dataset = self.datasets[ds_id]
+            Dataset.objects.filter(id=ds_id).update(
+                description=dataset.description,
+                directory=dataset.directory)
+        self.datasets = {}
+        self.dirty_datasets = set()
+
+    def find_datafile(self, top, filename, df_data):
         try:
             existing_dfs = DataFile.objects.filter(
                 filename=filename,
@@ -606,33 +1143,52 @@ class ASSquashParser(object):
                 existing_df = None
         except DataFile.DoesNotExist:
             existing_df = None
+        return existing_df
+
+    def read_file_details(self, top, filename):
+        '''
+        everything needed from the archive to register a file, {} for links
+        '''
+        fullpath = os.path.join(top, filename)
+        # df_data usually is {md5, sha512, size}
+        df_data = self.get_file_details(top, filename)
+        if df_data == {}:
+            return df_data
         df_data.update({
             'created_time': make_aware(self.sq_inst.created_time(fullpath)),
             'modification_time': make_aware(
                 self.sq_inst.modified_time(fullpath)),
             # 'modified_time' is more standard, but will stick with df model
         })
-        return existing_df, df_data
+        return df_data
 
-    def find_existing_dfo(self, top, filename):
-        '''
-        check whether this parser had previously registered this file
+    def get_file_details(self, top, filename):
         '''
-        try:
-            DataFileObject.objects.get(
-                storage_box=self.s_box,
-                uri=os.path.join(top, filename),
-                datafile__dataset__experiments=self.experiment)
-            return True
-        except DataFileObject.DoesNotExist:
-            return False
+        size and checksums of a file
 
-    def get_file_details(self, top, filename):
+        checksums are taken from the content index if a file with the same
+        name, size, mtime and fingerprint was hashed before, in this or
+        another archive, unless SQUASHFS_CONTENT_INDEX is False
+        '''
         fullpath = os.path.join(top, filename)
         try:
             fo = self.sq_inst.open(fullpath)
             size = fo.size
-            checksums = compute_checksums(fo)
+            checksums = None
+            if CONTENT_INDEX:
+                mtime = int(os.stat(self.sq_inst.path(fullpath)).st_mtime)
+                fingerprint = content_fingerprint(fo, size)
+                checksums = lookup_content_index(
+                    filename, size, mtime, fingerprint)
+            if checksums is None:
+                checksums = compute_checksums(fo)
+                if CONTENT_INDEX:
+                    add_to_content_index(
+                        filename, size, mtime, fingerprint, checksums,
+                        '%s:%s' % (self.epn, fullpath))
+            else:
+                fo.close()
+                self.duplicates.append((fullpath, checksums['origin']))
         except IOError as e:
             log.debug('squash parse error')
             log.debug(e)
@@ -643,6 +1199,85 @@ class ASSquashParser(object):
                 'md5sum': checksums['md5sum'],
                 'sha512sum': checksums['sha512sum']}
 
+    def build_manifest(self):
+        '''
+        returns {uri: (size, mtime)} for all files that a parse would
+        register
+
+        follows the same rules as parse: hidden entries, ignored folders,
+        top level folders other than frames and home, and broken links are
+        left out
+        '''
+        manifest = {}
+        dirnames, filenames = self.listdir('.')
+        self.add_to_manifest(manifest, '.', filenames)
+        if 'frames' in dirnames:
+            frames_dirs, frames_files = self.listdir('frames')
+            self.add_to_manifest(manifest, 'frames', frames_files)
+            for dirname in frames_dirs:
+                self.walk_manifest(manifest, os.path.join('frames', dirname),
+                                   ignore=self.frames_ignore_paths)
+        if 'home' in dirnames:
+            home_dirs, home_files = self.listdir('home')
+            self.add_to_manifest(manifest, 'home', home_files)
+            for dirname in home_dirs:
+                if self.typical_home.get(dirname, {}).get('ignore', False):
+                    continue
+                self.walk_manifest(manifest, os.path.join('home', dirname))
+        return manifest
+
+    def add_to_manifest(self, manifest, top, filenames):
+        for filename in filenames:
+            uri = os.path.join(top, filename)
+            try:
+                stat = os.stat(self.sq_inst.path(uri))
+                manifest[uri] = (stat.st_size, int(stat.st_mtime))
+            except OSError as err:
+                log.debug(err)
+
+    def walk_manifest(self, manifest, subdir, ignore=None):
+        dirnames, filenames = self.listdir(subdir)
+        self.add_to_manifest(manifest, subdir, filenames)
+        for dirname in dirnames:
+            if ignore is not None and dirname in ignore:
+                continue
+            self.walk_manifest(manifest, os.path.join(subdir, dirname),
+                               ignore)
+
+    def verify(self, checksums=False):
+        '''
+        compare the archive contents with the files registered in its
+        storage box without writing to the database
+
+        returns a dict of sorted uri lists:
+            missing: in the archive, not registered
+            extra: registered, not in the archive
+            mismatched: size differs, or md5sum if checksums is True
+        '''
+        manifest = self.build_manifest()
+        registered = {}
+        if self.s_box.pk is not None:
+            # an unsaved storage box has nothing registered
+            for uri, size, md5sum in DataFileObject.objects.filter(
+                    storage_box=self.s_box).values_list(
+                        'uri', 'datafile__size', 'datafile__md5sum'):
+                registered[uri] = (size, md5sum)
+        archived = set(manifest.keys())
+        known = set(registered.keys())
+        mismatched = []
+        for uri in archived & known:
+            size, md5sum = registered[uri]
+            if size is None or int(size) != manifest[uri][0]:
+                mismatched.append(uri)
+            elif checksums:
+                # always hash, the content index only samples files
+                computed = compute_checksums(self.sq_inst.open(uri))
+                if computed['md5sum'] != md5sum:
+                    mismatched.append(uri)
+        return {'missing': sorted(archived - known),
+                'extra': sorted(known - archived),
+                'mismatched': sorted(mismatched)}
+
     def get_or_create_dataset(self, name, top=None):
         '''
         returns existing or created dataset given a name
@@ -677,15 +1312,16 @@ class ASSquashParser(object):
         filenames = [f for f in filenames if not f.startswith('.')]
         return dirnames, filenames
 
-    def tag_user(self, dataset, path):
+    def tag_user(self, dataset, path, overwrite=False):
         elems = path.split(os.sep)
         username = None
         for elem in elems:
             if elem in self.metadata.get('usernames', []):
                 username = elem
                 break
-        if username is None:
+        if username is None or (dataset.id, username) in self.tagged_datasets:
             return
+        self.tagged_datasets.add((dataset.id, username))
         ns = 'http://synchrotron.org.au/userinfo'
         schema, created = Schema.objects.get_or_create(
             name="Synchrotron User Information",
@@ -715,25 +1351,43 @@ class ASSquashParser(object):
         data = self.metadata['usernames'][username]
         p_name, created = DatasetParameter.objects.get_or_create(
             name=pn_name, parameterset=ps)
-        if p_name.string_value is None or p_name.string_value == '':
+        if overwrite or p_name.string_value is None or \
+                p_name.string_value == '':
             p_name.string_value = data['Name']
             p_name.save()
         p_email, created = DatasetParameter.objects.get_or_create(
             name=pn_email, parameterset=ps)
-        if p_email.string_value is None or p_email.string_value == '':
+        if overwrite or p_email.string_value is None or \
+                p_email.string_value == '':
             p_email.string_value = data['Email']
             p_email.save()
         p_scientistid, created = DatasetParameter.objects.get_or_create(
             name=pn_scientistid, parameterset=ps)
-        if p_scientistid.string_value is None or \
-                        p_scientistid.string_value == '':
+        if overwrite or p_scientistid.string_value is None or \
+                p_scientistid.string_value == '':
             p_scientistid.string_value = data['ScientistID']
             p_scientistid.save()
 
+    def report_duplicates(self):
+        '''
+        log files that were first seen in other archives
+        '''
+        own_prefix = '%s:' % self.epn
+        duplicates = [(uri, origin) for uri, origin in self.duplicates
+                      if not origin.startswith(own_prefix)]
+        if len(duplicates) == 0:
+            return
+        log.info('EPN %s: %d files duplicate files of other archives',
+                 self.epn, len(duplicates))
+        for uri, origin in duplicates:
+            log.debug('EPN %s: %s duplicates %s', self.epn, uri, origin)
+
     def update_dataset(self, dataset, top):
         '''
         update dataset with directory if none is set or its first two elems
         are different
+
+        the change is kept in memory until the next flush_datasets
         '''
         split_top = top.split(os.sep)
         comp_dir = None
@@ -743,33 +1397,90 @@ class ASSquashParser(object):
                                              not dataset.directory.startswith(
                                                  comp_dir)):
             dataset.directory = top
-            dataset.save()
+            self.dirty_datasets.add(dataset.id)
         self.tag_user(dataset, top)
 
 
-def parse_squashfs_file(squashfile, ns):
+def parse_squashfs_file(squashfile, ns, hash_workers=PARSE_HASH_WORKERS):
     '''
     parse Australian Synchrotron specific SquashFS archive files
     '''
 
-    parser = ASSquashParser(squashfile, ns)
+    parser = ASSquashParser(squashfile, ns, hash_workers)
     return parser.parse()
 
 
-def register_squashfile(exp_id, epn, sq_dir, sq_filename, namespace):
+def read_squashfs_superblock(sq_path):
+    '''
+    returns (inode count, bytes used) from the superblock of a SquashFS 4
+    archive
+    '''
+    with open(sq_path, 'rb') as sq_file:
+        superblock = sq_file.read(48)
+    if len(superblock) < 48:
+        raise ValueError('%s is too short for a SquashFS archive' % sq_path)
+    fields = struct.unpack('<5I6H2Q', superblock)
+    if fields[0] != SQUASHFS_MAGIC:
+        raise ValueError('%s is not a SquashFS archive' % sq_path)
+    return fields[1], fields[-1]
+
+
+def estimate_parse_cost(sq_path, squashfile=None):
+    '''
+    estimate the cost of parsing an archive without opening its contents
+
+    the superblock only has the number of inodes, which includes directories
+    and links, and the compressed size of the archive. files already
+    registered from the archive's storage box are skipped by the parser, so
+    their inodes and their share of the compressed bytes don't count towards
+    the estimate. a fully registered archive still costs its directories.
+
+    returns a dict with inodes, compressed_bytes, registered, new_inodes,
+    new_compressed_bytes and seconds
+    '''
+    inodes, bytes_used = read_squashfs_superblock(sq_path)
+    registered = 0
+    if squashfile is not None:
+        s_box_ids = StorageBoxOption.objects.filter(
+            key='datafile_id', value=squashfile.id
+        ).values_list('storage_box', flat=True)
+        registered = DataFileObject.objects.filter(
+            storage_box__in=list(s_box_ids)).count()
+    new_inodes = max(inodes - registered, 0)
+    new_compressed_bytes = bytes_used * new_inodes // max(inodes, 1)
+    return {'inodes': inodes,
+            'compressed_bytes': bytes_used,
+            'registered': registered,
+            'new_inodes': new_inodes,
+            'new_compressed_bytes': new_compressed_bytes,
+            'seconds': (new_inodes * PARSE_SECONDS_PER_INODE +
+                        new_compressed_bytes /
+                        float(PARSE_COMPRESSED_BYTES_PER_SECOND))}
+
+
+def verify_squashfs_file(squashfile, ns, checksums=False):
+    '''
+    check an archive against its registered files without parsing it or
+    writing to the database
+    '''
+    parser = ASSquashParser(squashfile, ns, read_only=True)
+    return parser.verify(checksums)
+
+
+def register_squashfile(exp_id, epn, sq_dir, sq_filename, namespace,
+                        sbox=None, schema=None):
     '''
     example:
     register_squashfile(456, '1234A', '/srv/squashstore', '1234A.squashfs',
         'http://synchrotron.org.au/mx/squashfsarchive/1')
+
+    sbox and schema can be passed in to save their lookup when registering
+    many files
     '''
     dfs = DataFile.objects.filter(filename=sq_filename,
                                   dataset__experiments__id=exp_id)
     if len(dfs) == 1:
         return dfs[0]
-    e = Experiment.objects.get(id=exp_id)
-    ds = Dataset(description="01 SquashFS Archive")
-    ds.save()
-    ds.experiments.add(e)
     filepath = os.path.join(sq_dir, sq_filename)
     try:
         md5sum = open(filepath + '.md5sum', 'r').read().strip()[:32]
@@ -777,14 +1488,103 @@ def register_squashfile(exp_id, epn, sq_dir, sq_filename, namespace):
         print 'no md5sum file found'
         return None
     size = os.path.getsize(filepath)
+    e = Experiment.objects.get(id=exp_id)
+    ds = Dataset(description="01 SquashFS Archive")
+    ds.save()
+    ds.experiments.add(e)
     df = DataFile(md5sum=md5sum, filename=sq_filename,
                   size=str(size), dataset=ds)
     df.save()
-    schema = Schema.objects.filter(namespace=namespace)[0]
+    if schema is None:
+        schema = Schema.objects.filter(namespace=namespace)[0]
     ps = DatafileParameterSet(schema=schema, datafile=df)
     ps.save()
     ps.set_param('EPN', epn)
-    sbox = StorageBox.objects.get(name='squashstore')
+    if sbox is None:
+        sbox = StorageBox.objects.get(name='squashstore')
     dfo = DataFileObject(storage_box=sbox, datafile=df, uri=sq_filename)
     dfo.save()
     return df
+
+
+def find_squashfiles(sq_dir):
+    '''
+    returns (epn, filename, size) for all archives in sq_dir, smallest first
+
+    archives without a .md5sum file are still being copied and left out
+    '''
+    suffix = '.squashfs'
+    archives = []
+    filenames = set(os.listdir(sq_dir))
+    for filename in filenames:
+        if not filename.endswith(suffix) or \
+                filename + '.md5sum' not in filenames:
+            continue
+        size = os.path.getsize(os.path.join(sq_dir, filename))
+        archives.append((filename[:-len(suffix)], filename, size))
+    return sorted(archives, key=lambda archive: archive[2])
+
+
+def register_squashfiles(sq_dir, namespace, exp_title='Experiment %s'):
+    '''
+    register all archives in sq_dir that are not registered yet
+
+    experiments and existing registrations are looked up for all archives at
+    once. returns (epn, filename, size) of all registered archives in sq_dir,
+    new or not, smallest first
+    '''
+    archives = find_squashfiles(sq_dir)
+    exp_ids = dict(Experiment.objects.filter(
+        title__in=[exp_title % epn for epn, filename, size in archives]
+    ).values_list('title', 'id'))
+    registered = set(DataFile.objects.filter(
+        filename__in=[filename for epn, filename, size in archives],
+        dataset__experiments__id__in=exp_ids.values()
+    ).values_list('filename', 'dataset__experiments__id'))
+    schema = Schema.objects.filter(namespace=namespace)[0]
+    sbox = StorageBox.objects.get(name='squashstore')
+    registered_archives = []
+    for epn, filename, size in archives:
+        exp_id = exp_ids.get(exp_title % epn)
+        if exp_id is None:
+            log.debug('no experiment for EPN %s', epn)
+            continue
+        if (filename, exp_id) in registered:
+            registered_archives.append((epn, filename, size))
+            continue
+        df = register_squashfile(exp_id, epn, sq_dir, filename, namespace,
+                                 sbox=sbox, schema=schema)
+        if df is not None:
+            registered_archives.append((epn, filename, size))
+    return registered_archives
+
+
+def get_parse_statuses(sq_filenames, namespace):
+    '''
+    returns {filename: {parameter name: value}} with the parse_status,
+    parse_lane and parse_deadline parameters the archives have
+    '''
+    statuses = {}
+    for filename, name, value in DatafileParameter.objects.filter(
+            parameterset__schema__namespace=namespace,
+            parameterset__datafile__filename__in=sq_filenames,
+            name__name__in=['parse_status', 'parse_lane', 'parse_deadline']
+    ).values_list('parameterset__datafile__filename', 'name__name',
+                  'string_value'):
+        statuses.setdefault(filename, {})[name] = value
+    return statuses
+
+
+def set_parse_status(sq_filename, namespace, status, lane=None,
+                     deadline=None):
+    '''
+    lane is the id of the celery task parsing the archive, deadline the unix
+    time by which that task has ended at the latest
+    '''
+    for ps in DatafileParameterSet.objects.filter(
+            datafile__filename=sq_filename, schema__namespace=namespace):
+        ps.set_param('parse_status', status)
+        if lane is not None:
+            ps.set_param('parse_lane', lane)
+        if deadline is not None:
+            ps.set_param('parse_deadline', str(deadline))
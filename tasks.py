@@ -1,26 +1,308 @@
+import logging
 import os
+import time
 
+from celery.exceptions import SoftTimeLimitExceeded
 from celery.task import task
+from celery.utils import uuid
+from django.conf import settings
+from django.core.cache import cache
 
-from tardis.tardis_portal.models import Experiment
+from tardis.tardis_portal.models import DataFile, Experiment
 
+from tardis.apps.synch_squash_parser.parser import PARSE_HASH_WORKERS
+from tardis.apps.synch_squash_parser.parser import estimate_parse_cost
+from tardis.apps.synch_squash_parser.parser import get_parse_statuses
 from tardis.apps.synch_squash_parser.parser import parse_squashfs_file
 from tardis.apps.synch_squash_parser.parser import register_squashfile
+from tardis.apps.synch_squash_parser.parser import register_squashfiles
+from tardis.apps.synch_squash_parser.parser import set_parse_status
+from tardis.apps.synch_squash_parser.parser import verify_squashfs_file
+
+log = logging.getLogger(__name__)
+
+SQUASHSTORE = '/srv/rdsi-tape/squashstore'
+NAMESPACE = 'http://synchrotron.org.au/mx/squashfsarchive/1'
+MAX_PARSES_PER_VOLUME = getattr(settings, 'SQUASHFS_MAX_PARSES_PER_VOLUME', 2)
+MAX_PARSES_PER_DB = getattr(settings, 'SQUASHFS_MAX_PARSES_PER_DB', 8)
+# parse_status values of parses that count against the limits until their
+# parse_deadline
+ACTIVE_STATUSES = ('queued', 'running')
+PARSE_ALL_LOCK = 'synch_squash_parser.parse_all'
+# (max estimated seconds or None, queue, soft time limit in seconds,
+#  hash workers)
+PARSE_ROUTES = getattr(settings, 'SQUASHFS_PARSE_ROUTES', [
+    (10 * 60, 'celery', 60 * 60, 1),
+    (6 * 60 * 60, 'squashfs_parse', 24 * 60 * 60, 2),
+    (None, 'squashfs_parse_large', 7 * 24 * 60 * 60, 4),
+])
+# time between the soft and the hard time limit to record unfinished parses
+PARSE_TIME_LIMIT_GRACE = getattr(
+    settings, 'SQUASHFS_PARSE_TIME_LIMIT_GRACE', 15 * 60)
+# queued parses that have not started by then are dropped by celery
+PARSE_QUEUE_EXPIRY = getattr(
+    settings, 'SQUASHFS_PARSE_QUEUE_EXPIRY', 24 * 60 * 60)
 
 
 def reset_status(dfid):
     df = DataFile.objects.get(id=dfid)
-    ps = df.datafileparameterset_set.all()[0]
-    ps.set_param('parse_status', 'incomplete')
+    set_parse_status(df.filename, NAMESPACE, 'incomplete')
+
+
+def get_volume(sq_dir, sq_filename):
+    return os.stat(os.path.realpath(os.path.join(sq_dir, sq_filename))).st_dev
+
+
+def get_active_lanes(sq_dir, archives, statuses):
+    '''
+    returns {lane id: set of volumes} for the lanes that still have queued or
+    running archives and have not passed their deadline
+
+    archives of lanes past their deadline were lost to a killed worker,
+    an expired queue entry or the like, and are parsed again
+    '''
+    now = time.time()
+    lanes = {}
+    for epn, filename, size in archives:
+        status = statuses.get(filename, {})
+        if not is_active(status, now):
+            continue
+        lanes.setdefault(status['parse_lane'], set()).add(
+            get_volume(sq_dir, filename))
+    return lanes
+
+
+def is_active(status, now):
+    if status.get('parse_status') not in ACTIVE_STATUSES or \
+            'parse_lane' not in status:
+        return False
+    try:
+        return float(status.get('parse_deadline')) > now
+    except (TypeError, ValueError):
+        return False
+
+
+def plan_lanes(sq_dir, archives, active_lanes=None):
+    '''
+    distribute archives over lanes that are parsed one archive at a time
+
+    each storage volume gets up to MAX_PARSES_PER_VOLUME lanes and there are
+    no more than MAX_PARSES_PER_DB lanes overall, less the active lanes from
+    get_active_lanes. archives are (epn, filename, size) and each lane is
+    ordered smallest first. archives that don't fit into a lane are left out
+    '''
+    active_lanes = active_lanes or {}
+    active_volumes = {}
+    for devices in active_lanes.values():
+        for device in devices:
+            active_volumes[device] = active_volumes.get(device, 0) + 1
+    volumes = {}
+    for archive in archives:
+        volumes.setdefault(get_volume(sq_dir, archive[1]), []).append(archive)
+    volume_lanes = []
+    for device, volume_archives in volumes.items():
+        n_lanes = min(MAX_PARSES_PER_VOLUME - active_volumes.get(device, 0),
+                      len(volume_archives))
+        if n_lanes <= 0:
+            continue
+        volume_lanes += [volume_archives[i::n_lanes] for i in range(n_lanes)]
+    n_lanes = min(MAX_PARSES_PER_DB - len(active_lanes), len(volume_lanes))
+    if n_lanes <= 0:
+        return []
+    lanes = [[] for i in range(n_lanes)]
+    for i, lane in enumerate(volume_lanes):
+        lanes[i % n_lanes] += lane
+    return [sorted(lane, key=lambda archive: archive[2]) for lane in lanes]
+
+
+def route_parse(seconds):
+    '''
+    returns (queue, soft time limit, hash workers) for a parse estimated to
+    take seconds, unknown estimates go to the last route
+    '''
+    for max_seconds, queue, time_limit, hash_workers in PARSE_ROUTES:
+        if seconds is not None and (max_seconds is None or
+                                    seconds <= max_seconds):
+            return queue, time_limit, hash_workers
+    return tuple(PARSE_ROUTES[-1][1:])
+
+
+def estimate_seconds(sq_dir, sq_filename, squashfile=None):
+    try:
+        return estimate_parse_cost(
+            os.path.join(sq_dir, sq_filename), squashfile)['seconds']
+    except (IOError, ValueError) as err:
+        log.warning('cannot estimate parse cost of %s: %s', sq_filename, err)
+        return None
+
+
+def queue_parse(epn, sq_dir=SQUASHSTORE):
+    '''
+    queue a parse on the queue and with the time limit fitting its
+    estimated cost
+    '''
+    sq_filename = '%s.squashfs' % epn
+    try:
+        squashfile = DataFile.objects.get(
+            filename=sq_filename,
+            dataset__experiments__title="Experiment %s" % epn)
+    except DataFile.DoesNotExist:
+        squashfile = None
+    queue, time_limit, hash_workers = route_parse(
+        estimate_seconds(sq_dir, sq_filename, squashfile))
+    task_id = uuid()
+    if squashfile is not None:
+        mark_queued([sq_filename], task_id, time_limit)
+    return parse.apply_async(args=[epn, sq_dir, hash_workers], queue=queue,
+                             soft_time_limit=time_limit,
+                             time_limit=time_limit + PARSE_TIME_LIMIT_GRACE,
+                             expires=PARSE_QUEUE_EXPIRY, task_id=task_id)
+
+
+def mark_queued(sq_filenames, task_id, time_limit):
+    '''
+    record the task that parses the archives and when it will have ended
+    at the latest: after waiting in the queue until it expires and then
+    running up to its hard time limit
+    '''
+    deadline = int(time.time() + PARSE_QUEUE_EXPIRY + time_limit +
+                   PARSE_TIME_LIMIT_GRACE)
+    for sq_filename in sq_filenames:
+        set_parse_status(sq_filename, NAMESPACE, 'queued', task_id, deadline)
 
 
 @task(name='apps.synch_squash_parser.parse')
-def parse(epn):
-    namespace = 'http://synchrotron.org.au/mx/squashfsarchive/1'
+def parse(epn, sq_dir=SQUASHSTORE, hash_workers=PARSE_HASH_WORKERS):
+    '''
+    parse an archive and record the outcome in its parse_status
+    '''
+    sq_filename = '%s.squashfs' % epn
     sq_df = register_squashfile(
         Experiment.objects.get(title="Experiment %s" % epn).id,
         epn,
-        '/srv/rdsi-tape/squashstore',
-        '%s.squashfs' % epn,
-        namespace)
-    return parse_squashfs_file(sq_df, namespace)
+        sq_dir,
+        sq_filename,
+        NAMESPACE)
+    if sq_df is None:
+        return False
+    set_parse_status(sq_filename, NAMESPACE, 'running')
+    try:
+        result = parse_squashfs_file(sq_df, NAMESPACE, hash_workers)
+    except SoftTimeLimitExceeded:
+        set_parse_status(sq_filename, NAMESPACE, 'incomplete')
+        raise
+    except Exception:
+        set_parse_status(sq_filename, NAMESPACE, 'failed')
+        raise
+    set_parse_status(sq_filename, NAMESPACE,
+                     'complete' if result else 'failed')
+    return result
+
+
+@task(name='apps.synch_squash_parser.verify')
+def verify(epn, checksums=False):
+    sq_df = DataFile.objects.get(
+        filename='%s.squashfs' % epn,
+        dataset__experiments__title="Experiment %s" % epn)
+    return verify_squashfs_file(sq_df, NAMESPACE, checksums)
+
+
+@task(name='apps.synch_squash_parser.parse_lane')
+def parse_lane(epns, sq_dir=SQUASHSTORE, hash_workers=PARSE_HASH_WORKERS):
+    '''
+    parse archives one after the other, a failure does not stop the lane
+
+    when the soft time limit is hit, the archives not parsed yet are marked
+    incomplete so that parse_all queues them again
+    '''
+    results = {}
+    for i, epn in enumerate(epns):
+        try:
+            results[epn] = parse(epn, sq_dir, hash_workers)
+        except SoftTimeLimitExceeded:
+            unfinished = epns[i:]
+            log.warning('time limit hit, EPNs not parsed: %s',
+                        ', '.join(unfinished))
+            for unfinished_epn in unfinished:
+                set_parse_status('%s.squashfs' % unfinished_epn, NAMESPACE,
+                                 'incomplete')
+                results[unfinished_epn] = False
+            break
+        except Exception:
+            log.exception('parsing EPN %s failed', epn)
+            results[epn] = False
+    return results
+
+
+@task(name='apps.synch_squash_parser.parse_all')
+def parse_all(sq_dir=SQUASHSTORE):
+    '''
+    register all new archives in sq_dir and queue parses for the ones that
+    are not complete, as far as the parse limits allow
+
+    queued and running parses count against the limits by lane, whether
+    they were queued by parse_all or queue_parse. archives that don't fit are
+    queued by a later call, so this is meant to run periodically. archives of
+    a lane that was lost are queued again once the lane's deadline passed
+    '''
+    if not cache.add(PARSE_ALL_LOCK, True, 60 * 60):
+        log.info('parse_all is already running')
+        return 0
+    try:
+        return queue_lanes(sq_dir)
+    finally:
+        cache.delete(PARSE_ALL_LOCK)
+
+
+def queue_lanes(sq_dir):
+    '''
+    queue lanes for pending archives, each lane holding archives of one route
+    only. routes for smaller parses get their lanes first
+    '''
+    archives = register_squashfiles(sq_dir, NAMESPACE)
+    statuses = get_parse_statuses(
+        [filename for epn, filename, size in archives], NAMESPACE)
+    now = time.time()
+    pending = [archive for archive in archives
+               if statuses.get(archive[1], {}).get('parse_status') !=
+               'complete' and
+               not is_active(statuses.get(archive[1], {}), now)]
+    squashfiles = dict((df.filename, df) for df in DataFile.objects.filter(
+        filename__in=[filename for epn, filename, size in pending],
+        datafileparameterset__schema__namespace=NAMESPACE).distinct())
+    estimates = {}
+    routes = {}
+    for epn, filename, size in pending:
+        estimates[filename] = estimate_seconds(
+            sq_dir, filename, squashfiles.get(filename))
+        routes.setdefault(route_parse(estimates[filename]), []).append(
+            (epn, filename, size))
+    route_order = [tuple(route[1:]) for route in PARSE_ROUTES]
+    active_lanes = get_active_lanes(sq_dir, archives, statuses)
+    n_queued = 0
+    n_lanes = 0
+    for route in sorted(routes.keys(), key=route_order.index):
+        queue, time_limit, hash_workers = route
+        for lane in plan_lanes(sq_dir, routes[route], active_lanes):
+            lane_estimates = [estimates[filename]
+                              for epn, filename, size in lane]
+            lane_time_limit = time_limit
+            if None not in lane_estimates:
+                lane_time_limit = max(time_limit,
+                                      int(sum(lane_estimates)) * 2)
+            task_id = uuid()
+            mark_queued([filename for epn, filename, size in lane], task_id,
+                        lane_time_limit)
+            parse_lane.apply_async(
+                args=[[epn for epn, filename, size in lane], sq_dir,
+                      hash_workers],
+                queue=queue, soft_time_limit=lane_time_limit,
+                time_limit=lane_time_limit + PARSE_TIME_LIMIT_GRACE,
+                expires=PARSE_QUEUE_EXPIRY, task_id=task_id)
+            active_lanes[task_id] = set(get_volume(sq_dir, filename)
+                                        for epn, filename, size in lane)
+            n_queued += len(lane)
+            n_lanes += 1
+    log.info('queued %d of %d pending archives in %d lanes',
+             n_queued, len(pending), n_lanes)
+    return n_queued